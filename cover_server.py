@@ -7,36 +7,70 @@ This script combines the pyatv listener logic with an HTTP server and
 image processing pipeline. The data source is determined by the config.yaml file.
 """
 import asyncio
+import hashlib
 import io
 import logging
 import re
 import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-import paho.mqtt.client as mqtt
+import aiomqtt
+import PIL
 import pyatv
 import yaml
 from aioesphomeapi import APIClient
-from PIL import Image
+from aiohttp import web
+from PIL import Image, features
 from pyatv import exceptions
 from pyatv.interface import Playing
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 # --- Global variables ---
+# Both formats of a cover travel together so a single rebind swaps them atomically.
+Cover = namedtuple("Cover", ["jpeg", "png", "jpeg_etag", "png_etag"])
+
 config = {}
-current_cover_jpeg = None
-current_cover_png = None
-default_cover_jpeg_bytes = None
-default_cover_png_bytes = None
+# Image processing settings, resolved once from config by load_config().
+image_size = None
+jpeg_quality = None
+current_cover = Cover(None, None, None, None)
+default_cover = Cover(None, None, None, None)
+artwork_cache = OrderedDict()
+artwork_cache_lock = threading.Lock()
+ARTWORK_CACHE_SIZE = 32
+# Pillow releases the GIL inside its codecs, so JPEG and PNG encode overlap.
+# Image.save() keeps per-call encoder state on the image, so each encode
+# must get its own Image object.
+encoder_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="encoder")
+esphome_client = None
+esphome_service = None
+esphome_backoff = 0
+esphome_retry_at = 0.0
+# Serializes ESPHome connects; created in main() once the event loop exists.
+esphome_lock = None
+ESPHOME_MAX_BACKOFF = 60
 logger = logging.getLogger(__name__)
 
 
 # --- Configuration and Setup ---
 def load_config():
     """Loads configuration from YAML."""
-    global config
+    global config, image_size, jpeg_quality
     try:
         with open("config.yaml", "r") as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=YamlLoader)
+        image_size = tuple(config["image_size"])
+        jpeg_quality = int(config["jpeg_quality"])
         logger.info("Configuration loaded.")
     except Exception as e:
         logger.critical(f"Failed to load configuration: {e}")
@@ -54,47 +88,161 @@ def setup_logging():
 # --- Image Processing ---
 def process_image(img):
     """Resizes and converts image to RGB."""
-    img_rgb = img.convert("RGB")
-    return img_rgb.resize(tuple(config["image_size"]), Image.LANCZOS)
+    # Lets libjpeg scale down by 1/2, 1/4 or 1/8 during decode; no-op for other formats.
+    img.draft("RGB", image_size)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    # reducing_gap=3.0: sources more than 6x the target are first box-reduced
+    # by an integer factor, so Lanczos never filters more than just under 6x.
+    return img.resize(image_size, Image.LANCZOS, reducing_gap=3.0)
 
 
 def img_to_jpeg_bytes(img):
     """Converts PIL image to JPEG bytes."""
     with io.BytesIO() as byte_arr:
-        img.save(byte_arr, format="JPEG", quality=config["jpeg_quality"])
+        img.save(byte_arr, format="JPEG", quality=jpeg_quality)
         return byte_arr.getvalue()
 
 
 def img_to_lossy_png_bytes(img):
     """Converts PIL image to PNG bytes."""
     with io.BytesIO() as byte_arr:
-        img.save(byte_arr, format="PNG", optimize=True)
+        img.save(byte_arr, format="PNG", optimize=False, compress_level=1)
         return byte_arr.getvalue()
 
 
+def compute_etag(data):
+    """Returns the (unquoted) HTTP ETag value for image bytes."""
+    if not data:
+        return None
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def make_cover(jpeg_bytes, png_bytes):
+    """Builds a Cover, precomputing the ETag of each image."""
+    return Cover(jpeg_bytes, png_bytes, compute_etag(jpeg_bytes), compute_etag(png_bytes))
+
+
+def guess_image_formats(payload):
+    """Returns the Pillow format of common artwork payloads, or None to let Pillow probe."""
+    if payload.startswith(b"\xff\xd8\xff"):
+        return ["JPEG"]
+    if payload.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ["PNG"]
+    return None
+
+
+def encode_artwork(payload):
+    """Processes raw artwork bytes into a Cover, reusing recent results."""
+    key = hashlib.blake2b(payload, digest_size=8).digest()
+    with artwork_cache_lock:
+        encoded = artwork_cache.get(key)
+        if encoded is not None:
+            artwork_cache.move_to_end(key)
+            return encoded
+
+    with Image.open(io.BytesIO(payload), formats=guess_image_formats(payload)) as img:
+        processed_img = process_image(img)
+    jpeg_future = encoder_pool.submit(img_to_jpeg_bytes, processed_img)
+    png_future = encoder_pool.submit(img_to_lossy_png_bytes, processed_img.copy())
+    encoded = make_cover(jpeg_future.result(), png_future.result())
+
+    with artwork_cache_lock:
+        artwork_cache[key] = encoded
+        if len(artwork_cache) > ARTWORK_CACHE_SIZE:
+            artwork_cache.popitem(last=False)
+    return encoded
+
+
 def load_default_cover():
     """Loads and processes the default cover images."""
-    global current_cover_jpeg, current_cover_png, default_cover_jpeg_bytes, default_cover_png_bytes
+    global current_cover, default_cover
+    jpeg_bytes = None
+    png_bytes = None
     try:
         with Image.open(config["default_cover_jpeg"]) as img:
             processed_img = process_image(img)
-            default_cover_jpeg_bytes = img_to_jpeg_bytes(processed_img)
-            current_cover_jpeg = default_cover_jpeg_bytes
+            jpeg_bytes = img_to_jpeg_bytes(processed_img)
             logger.info("Loaded default JPEG cover.")
         with Image.open(config["default_cover_png"]) as img:
             processed_img = process_image(img)
-            default_cover_png_bytes = img_to_lossy_png_bytes(processed_img)
-            current_cover_png = default_cover_png_bytes
+            png_bytes = img_to_lossy_png_bytes(processed_img)
             logger.info("Loaded default PNG cover.")
     except FileNotFoundError as e:
         logger.warning(f"Default cover image not found: {e}")
     except Exception as e:
         logger.error(f"Error loading default cover: {e}")
+    default_cover = make_cover(jpeg_bytes, png_bytes)
+    current_cover = default_cover
 
 
 # --- Asynchronous Logic (ESPHome and pyatv) ---
+async def disconnect_esphome(cli=None):
+    """Disconnects an ESPHome client, dropping it from the cache if it is the cached one.
+
+    Without an argument, the cached client (if any) is disconnected.
+    """
+    global esphome_client, esphome_service
+    cli = cli or esphome_client
+    if cli is None:
+        return
+    if cli is esphome_client:
+        esphome_client = None
+        esphome_service = None
+    try:
+        await cli.disconnect()
+    except Exception as e:
+        logger.debug(f"Error while disconnecting from ESPHome: {e}")
+
+
+async def get_esphome_service():
+    """Returns the cached (client, action) pair, (re)connecting to the device if needed.
+
+    Failed attempts back off exponentially, up to ESPHOME_MAX_BACKOFF seconds,
+    rather than reconnecting on every cover update. Returns (None, None) when
+    no connection is available.
+    """
+    global esphome_client, esphome_service, esphome_backoff, esphome_retry_at
+    async with esphome_lock:
+        if esphome_service:
+            return esphome_client, esphome_service
+
+        loop = asyncio.get_running_loop()
+        if loop.time() < esphome_retry_at:
+            logger.warning(
+                f"Skipping ESPHome action: next connection attempt in {esphome_retry_at - loop.time():.1f}s."
+            )
+            return None, None
+
+        esphome_config = config["esphome"]
+        action_name = esphome_config["action_name"]
+        cli = APIClient(esphome_config["device_ip"], 6053, esphome_config.get("api_password"))
+        service = None
+        try:
+            await cli.connect(login=True)
+            _, services = await cli.list_entities_services()
+            service = next((s for s in services if s.name == action_name), None)
+            if not service:
+                logger.error(f"Action '{action_name}' not found on device.")
+        except Exception as e:
+            logger.error(f"Failed to connect to ESPHome device: {e}")
+
+        if not service:
+            await disconnect_esphome(cli)
+            esphome_backoff = min(esphome_backoff * 2 or 1, ESPHOME_MAX_BACKOFF)
+            esphome_retry_at = loop.time() + esphome_backoff
+            logger.info(f"Next ESPHome connection attempt in {esphome_backoff}s.")
+            return None, None
+
+        esphome_client = cli
+        esphome_service = service
+        esphome_backoff = 0
+        logger.info(f"Connected to ESPHome device {esphome_config['device_ip']}.")
+        return cli, service
+
+
 async def trigger_esphome_action():
-    """Connects and calls a user-defined action on an ESPHome device."""
+    """Calls a user-defined action on an ESPHome device over a persistent connection."""
     esphome_config = config.get("esphome", {})
     device_ip = esphome_config.get("device_ip")
     action_name = esphome_config.get("action_name")
@@ -103,21 +251,20 @@ async def trigger_esphome_action():
         return
 
     logger.info(f"Executing ESPHome action '{action_name}' for {device_ip}")
-    cli = APIClient(device_ip, 6053, esphome_config.get("api_password"))
-    try:
-        await cli.connect(login=True)
-        _, services = await cli.list_entities_services()
-        service_to_call = next((s for s in services if s.name == action_name), None)
-
-        if service_to_call:
-            await cli.execute_service(service_to_call, data={})
+    # A stale connection (e.g. the device rebooted) fails on first use;
+    # reconnect once and retry before giving up on this update.
+    for _ in range(2):
+        cli, service = await get_esphome_service()
+        if not service:
+            return
+        try:
+            await cli.execute_service(service, data={})
             logger.info(f"Successfully executed action '{action_name}'.")
-        else:
-            logger.error(f"Action '{action_name}' not found on device.")
-    except Exception as e:
-        logger.error(f"Error during ESPHome action: {e}")
-    finally:
-        await cli.disconnect()
+            return
+        except Exception as e:
+            logger.warning(f"Error during ESPHome action: {e}. Reconnecting.")
+            await disconnect_esphome(cli)
+    logger.error(f"Failed to execute ESPHome action '{action_name}'.")
 
 
 class HomePodListener(pyatv.interface.PushListener):
@@ -126,55 +273,50 @@ class HomePodListener(pyatv.interface.PushListener):
     def __init__(self, atv_instance):
         self.atv = atv_instance
         self.last_printed_title = None
+        self._pending_artwork = False
         self._connection_lost_event = asyncio.Event()
 
     def connection_lost(self, exception: Exception) -> None:
-        _LOGGER.warning("Connection lost to device: %s", exception)
+        logger.warning("Connection lost to device: %s", exception)
         self._connection_lost_event.set()
 
     async def _fetch_and_process_artwork(self, playstatus: Playing):
-        global current_cover_jpeg, current_cover_png
-        for attempt in range(5):
-            try:
-                artwork = await self.atv.metadata.artwork()
-                if artwork:
-                    with Image.open(io.BytesIO(artwork.bytes)) as img:
-                        processed_img = process_image(img)
-                        current_cover_jpeg = img_to_jpeg_bytes(processed_img)
-                        current_cover_png = img_to_lossy_png_bytes(processed_img)
-                    logger.info(f"Artwork found for {playstatus.title}. Updating current cover image.")
-                    await trigger_esphome_action()
-                    return
-                else:
-                    logger.info(f"No artwork available for {playstatus.title}.")
-                    return
-            except exceptions.BlockedStateError:
-                delay = 0.05 * (2**attempt)
-                _LOGGER.warning(
-                    f"Metadata blocked on attempt {attempt + 1}. Retrying in {delay}s..."
-                )
-                await asyncio.sleep(delay)
-            except Exception as e:
-                _LOGGER.error(f"Failed to fetch or process artwork: {e}")
-                return
-        _LOGGER.error(f"Failed to fetch artwork for {playstatus.title} after retries.")
+        global current_cover
+        try:
+            artwork = await self.atv.metadata.artwork()
+            if artwork:
+                # Keep the event loop (and the HTTP server) responsive while encoding.
+                current_cover = await asyncio.to_thread(encode_artwork, artwork.bytes)
+                logger.info(f"Artwork found for {playstatus.title}. Updating current cover image.")
+                await trigger_esphome_action()
+            else:
+                logger.info(f"No artwork available for {playstatus.title}.")
+        except exceptions.BlockedStateError:
+            # The device pushes another update once metadata is available;
+            # playstatus_update retries the fetch then instead of sleeping here.
+            logger.warning(f"Metadata blocked for {playstatus.title}. Waiting for next update.")
+            self._pending_artwork = True
+        except Exception as e:
+            logger.error(f"Failed to fetch or process artwork: {e}")
 
     def playstatus_update(self, updater, playstatus: Playing) -> None:
-        global current_cover_jpeg, current_cover_png
+        global current_cover
         title = playstatus.title or "No Title"
         state = playstatus.device_state.name
 
-        if title == self.last_printed_title and state == "Playing":
+        if title == self.last_printed_title and state == "Playing" and not self._pending_artwork:
             return
         self.last_printed_title = title if state == "Playing" else None
 
         if state == "Playing":
+            # Cleared here, not in the task, so pushes arriving before the
+            # retry runs don't schedule duplicate fetches.
+            self._pending_artwork = False
             asyncio.create_task(self._fetch_and_process_artwork(playstatus))
         else:
-            if current_cover_jpeg != default_cover_jpeg_bytes:
+            if current_cover is not default_cover:
                 logger.info("Reverting to default cover image.")
-                current_cover_jpeg = default_cover_jpeg_bytes
-                current_cover_png = default_cover_png_bytes
+                current_cover = default_cover
 
     def playstatus_error(self, updater, exception: Exception) -> None:
         logger.error(f"An error occurred during push update: {exception}")
@@ -224,98 +366,102 @@ async def pyatv_loop():
                 await asyncio.sleep(10)
 
 
-# --- Synchronous MQTT Logic ---
-def on_connect_mqtt(client, userdata, flags, rc, properties=None):
-    if rc == 0:
-        logger.info("Connected to MQTT broker.")
-        client.subscribe(config["mqtt"]["topic_cover"])
-        # Also subscribe to availability topic if defined
-        if config["mqtt"].get("topic_availability"):
-            client.subscribe(config["mqtt"]["topic_availability"])
-            logger.info(f"Subscribed to availability topic: {config['mqtt']['topic_availability']}")
-    else:
-        logger.error(f"MQTT connection failed with code {rc}")
-
-
-def on_message_mqtt(client, userdata, msg):
+# --- Asynchronous MQTT Logic ---
+async def on_message_mqtt(message):
     """Handles new artwork from an MQTT message."""
-    global current_cover_jpeg, current_cover_png
-    loop = userdata["loop"]
-    payload = msg.payload.decode('utf-8')
+    global current_cover
     mqtt_config = config["mqtt"]
 
     try:
         # Handle availability topic
-        if mqtt_config.get("topic_availability") and msg.topic == mqtt_config["topic_availability"]:
+        if mqtt_config.get("topic_availability") and message.topic.matches(mqtt_config["topic_availability"]):
+            payload = message.payload.decode("utf-8")
             if payload == mqtt_config.get("payload_not_available"):
-                if current_cover_jpeg != default_cover_jpeg_bytes:
+                if current_cover is not default_cover:
                     logger.info("Device not available. Reverting to default cover.")
-                    current_cover_jpeg = default_cover_jpeg_bytes
-                    current_cover_png = default_cover_png_bytes
+                    current_cover = default_cover
             elif payload == mqtt_config.get("payload_available"):
-                 logger.info("Device is available.")
+                logger.info("Device is available.")
             return
 
         # Handle cover art topic
-        if msg.topic == mqtt_config["topic_cover"]:
-            with Image.open(io.BytesIO(msg.payload)) as img:
-                processed_img = process_image(img)
-                current_cover_jpeg = img_to_jpeg_bytes(processed_img)
-                current_cover_png = img_to_lossy_png_bytes(processed_img)
+        if message.topic.matches(mqtt_config["topic_cover"]):
+            current_cover = await asyncio.to_thread(encode_artwork, message.payload)
             logger.info("Updated cover image from MQTT.")
-            asyncio.run_coroutine_threadsafe(trigger_esphome_action(), loop)
+            await trigger_esphome_action()
 
     except Exception as e:
         logger.error(f"Error processing MQTT message: {e}")
 
 
-def start_mqtt_client(loop):
-    """Initializes and starts the MQTT client."""
+async def mqtt_loop():
+    """Main MQTT connection and message loop."""
     mqtt_config = config["mqtt"]
-    mqtt_userdata = {"loop": loop}
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata=mqtt_userdata)
-    client.username_pw_set(mqtt_config.get("username"), mqtt_config.get("password"))
-    client.on_connect = on_connect_mqtt
-    client.on_message = on_message_mqtt
+    while True:
+        try:
+            async with aiomqtt.Client(
+                mqtt_config["broker"],
+                port=mqtt_config["port"],
+                username=mqtt_config.get("username"),
+                password=mqtt_config.get("password"),
+                keepalive=60,
+            ) as client:
+                logger.info("Connected to MQTT broker.")
+                await client.subscribe(mqtt_config["topic_cover"])
+                # Also subscribe to availability topic if defined
+                if mqtt_config.get("topic_availability"):
+                    await client.subscribe(mqtt_config["topic_availability"])
+                    logger.info(f"Subscribed to availability topic: {mqtt_config['topic_availability']}")
+
+                async for message in client.messages:
+                    await on_message_mqtt(message)
+        except aiomqtt.MqttError as e:
+            logger.error(f"MQTT connection error: {e}. Reconnecting in 10s...")
+            await asyncio.sleep(10)
+
+
+# --- Asynchronous HTTP Server ---
+def image_response(request, data, etag, content_type):
+    """Returns an HTTP response for an image, 304 if the client has it, or 404 if it is not loaded."""
+    if not data:
+        raise web.HTTPNotFound()
+    # If-None-Match uses weak comparison, so W/"..." tags match too.
+    if_none_match = request.if_none_match
+    if if_none_match and any(tag.value in (etag, "*") for tag in if_none_match):
+        response = web.Response(status=304)
+    else:
+        response = web.Response(body=data, content_type=content_type)
+    response.etag = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
-    try:
-        client.connect(mqtt_config["broker"], mqtt_config["port"], 60)
-        client.loop_start()
-        logger.info("MQTT client started.")
-        return client
-    except Exception as e:
-        logger.critical(f"Failed to start MQTT client: {e}")
-        exit(1)
 
+async def handle_cover_jpeg(request):
+    cover = current_cover
+    return image_response(request, cover.jpeg, cover.jpeg_etag, "image/jpeg")
 
-# --- Synchronous HTTP Server ---
-class CoverImageHandler(BaseHTTPRequestHandler):
-    """HTTP request handler for serving all cover images."""
 
-    def do_GET(self):
-        if self.path == config["served_jpeg_filename"]:
-            self.serve_image(current_cover_jpeg, "image/jpeg")
-        elif self.path == config["served_png_filename"]:
-            self.serve_image(current_cover_png, "image/png")
-        elif self.path == config["served_default_jpeg_filename"]:
-            self.serve_image(default_cover_jpeg_bytes, "image/jpeg")
-        elif self.path == config["served_default_png_filename"]:
-            self.serve_image(default_cover_png_bytes, "image/png")
-        else:
-            self.send_error(404)
+async def handle_cover_png(request):
+    cover = current_cover
+    return image_response(request, cover.png, cover.png_etag, "image/png")
 
-    def serve_image(self, data, content_type):
-        if not data:
-            self.send_error(404)
-            return
-        self.send_response(200)
-        self.send_header("Content-type", content_type)
-        self.send_header("Content-length", len(data))
-        self.end_headers()
-        self.wfile.write(data)
 
-    def log_message(self, format, *args):
-        return
+async def handle_default_jpeg(request):
+    return image_response(request, default_cover.jpeg, default_cover.jpeg_etag, "image/jpeg")
+
+
+async def handle_default_png(request):
+    return image_response(request, default_cover.png, default_cover.png_etag, "image/png")
+
+
+def create_http_app():
+    """Creates the web application serving all cover images."""
+    app = web.Application()
+    app.router.add_get(config["served_jpeg_filename"], handle_cover_jpeg)
+    app.router.add_get(config["served_png_filename"], handle_cover_png)
+    app.router.add_get(config["served_default_jpeg_filename"], handle_default_jpeg)
+    app.router.add_get(config["served_default_png_filename"], handle_default_png)
+    return app
 
 
 # --- Main Execution ---
@@ -330,16 +476,16 @@ async def cancel_all_tasks(loop):
     logger.info("All asyncio tasks cancelled.")
 
 
-def run_asyncio_loop(loop):
-    """Target for the asyncio thread."""
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
-
-
 def main():
     """Main entry point."""
+    global esphome_lock
     load_config()
     setup_logging()
+    logger.info(f"Configuration parsed with {YamlLoader.__name__}.")
+    logger.info(
+        f"Using Pillow {PIL.__version__} "
+        f"(SIMD: {'post' in PIL.__version__}, libjpeg-turbo: {features.check_feature('libjpeg_turbo')})"
+    )
     load_default_cover()
 
     use_homepod = "homepod" in config
@@ -357,47 +503,37 @@ def main():
         )
         exit(1)
 
-    loop = asyncio.new_event_loop()
-    client = None
-
-    # This thread will just run the event loop forever
-    asyncio_thread = threading.Thread(
-        target=run_asyncio_loop, args=(loop,), daemon=True
-    )
-    asyncio_thread.start()
-    logger.info("Asyncio event loop thread started.")
+    if uvloop:
+        loop = uvloop.new_event_loop()
+        logger.info("Using uvloop event loop.")
+    else:
+        loop = asyncio.new_event_loop()
+        logger.info("uvloop not available, using default asyncio event loop.")
+    asyncio.set_event_loop(loop)
+    esphome_lock = asyncio.Lock()
 
     if use_homepod:
         logger.info("Starting in HomePod mode.")
-        # Schedule the main async logic to run on the loop
-        asyncio.run_coroutine_threadsafe(pyatv_loop(), loop)
+        loop.create_task(pyatv_loop())
     else:  # use_mqtt
         logger.info("Starting in MQTT mode.")
-        client = start_mqtt_client(loop)
+        loop.create_task(mqtt_loop())
 
-    httpd = None
+    runner = web.AppRunner(create_http_app(), access_log=None)
     try:
-        httpd = HTTPServer(("", config["http_port"]), CoverImageHandler)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, port=config["http_port"])
+        loop.run_until_complete(site.start())
         logger.info(f"HTTP server running on port {config['http_port']}")
-        httpd.serve_forever()
+        loop.run_forever()
     except KeyboardInterrupt:
         logger.info("Shutting down.")
     finally:
-        if httpd:
-            httpd.server_close()
-        if use_mqtt and client and client.is_connected():
-            client.loop_stop()
-        
         # Gracefully stop the asyncio loop
-        if loop.is_running():
-            # Step 1: Cancel all running tasks
-            future = asyncio.run_coroutine_threadsafe(cancel_all_tasks(loop), loop)
-            future.result() # Wait for cancellation to complete
-
-            # Step 2: Stop the loop
-            loop.call_soon_threadsafe(loop.stop)
-
-        asyncio_thread.join()
+        loop.run_until_complete(cancel_all_tasks(loop))
+        loop.run_until_complete(runner.cleanup())
+        loop.run_until_complete(disconnect_esphome())
+        loop.close()
         logger.info("Shutdown complete.")
 
 